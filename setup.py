@@ -13,6 +13,13 @@ setup(
   install_requires=[
         'requests'
       ],
+  extras_require={
+        'async': ['aiohttp'],
+        'fast': ['orjson'],
+        'stream': ['ijson>=3.1'],
+        'http2': ['httpx[http2]'],
+        'brotli': ['brotli'],
+      },
   classifiers=[
     'Development Status :: 3 - Alpha',
     'Intended Audience :: Developers',
@@ -0,0 +1,200 @@
+# GNU GENERAL PUBLIC LICENSE
+# async_vodafonem2m.py
+
+
+import asyncio
+
+import aiohttp
+
+from vodafonem2m.m2m_device import M2MDevices
+from vodafonem2m.vodafonem2m import VodafoneM2M, json_loads
+
+
+class AsyncVodafoneM2M(VodafoneM2M):
+    """
+    asyncio variant of VodafoneM2M backed by an `aiohttp.ClientSession`.
+    Every request method returns an awaitable, so independent calls can be
+    run concurrently instead of one round trip at a time:
+
+        async with AsyncVodafoneM2M(username, password, client_id, client_secret) as m2m:
+            home_doc, ping = await asyncio.gather(m2m.get_home_document(), m2m.testing())
+
+    The auth token is fetched on the first request rather than in the constructor,
+    so instances can be created outside of a running event loop.
+    Attributes:
+        url (str): The api url for this client instance to use.
+        session (aiohttp.ClientSession): Persistent HTTP connection pool, created on first use.
+    """
+
+    # Connection pool sizing for the aiohttp connector.
+    connector_limit = 64
+    keepalive_timeout = 75
+
+    def _open_session(self):
+        if self.transport != 'requests':
+            raise ValueError("The transport option applies to the sync client only, "
+                             "AsyncVodafoneM2M always uses aiohttp")
+        self.session = None
+        # Created on first use, before Python 3.10 a lock binds to the loop current at creation.
+        self._refresh_lock = None
+        self._load_cached_token()
+
+    def _get_session(self):
+        """
+        Return the client session, creating it inside the running event loop.
+
+        :return: aiohttp.ClientSession
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connector_limit,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        """
+        Close the underlying client session.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _invalidate_token(self, authorization):
+        # Tasks only switch at awaits, so the check and the update can't interleave.
+        self._expire_token(authorization)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def set_auth_token(self, username=None, password=None):
+        """
+        Set the auth token.
+
+        :param username: Replaces the stored username when given.
+        :param password: Replaces the stored password when given.
+        :return:
+        """
+        if username is not None or password is not None:
+            self._set_credentials(username, password)
+        token = await self._send_message('post', '/m2m/v1/oauth2/access-token',
+                                         data=self._token_body, headers=self._token_headers)
+        self._store_token(token)
+        self._save_cached_token()
+
+    async def get_auth_token(self):
+        """
+        Gets the auth token, refreshing it if necessary.
+        Only one task refreshes an expired token, the others wait and reuse it.
+
+        :return: The auth token.
+        """
+        if self.token is None or self._is_token_expired():
+            if self._refresh_lock is None:
+                self._refresh_lock = asyncio.Lock()
+            async with self._refresh_lock:
+                if self.token is None or self._is_token_expired():
+                    await self.set_auth_token()  # Refresh the token
+        return self.token['access_token']
+
+    async def _send_message(self, method, endpoint, params=None, headers=None, data=None, stream=None,
+                            use_etag=False):
+        """
+        Send API request.
+
+        :param method:
+        :param endpoint:
+        :param params:
+        :param headers: Extra headers, merged over the Bearer auth headers. Requests
+            that carry their own 'Authorization' header are sent without the Bearer token.
+        :param data: Request body, encoded as JSON for 'application/json' requests
+            unless it is already `bytes`.
+        :param stream: Not supported by the async client.
+        :param use_etag: (bool) For idempotent GETs, revalidate the last response with
+            If-None-Match and return it again, without a body download, on 304 Not Modified.
+        :return: dict
+
+        """
+        if stream:
+            raise ValueError("stream is only supported by the sync client's 'requests' transport")
+
+        url = self._endpoint_url(endpoint)
+        if self.debug:
+            print(f"Sending {method} request to {url}: data: {data}, params: {params}, headers: {headers}")
+
+        if use_etag:
+            etag_key = self._etag_key(endpoint, params)
+            cached = self._etag_cache.get(etag_key)
+        else:
+            cached = None
+        headers, authenticated = self._caller_headers(headers)
+        retry_statuses = self._retry_statuses(method)
+
+        token_refreshed = False
+        for attempt in range(self.max_retries + 1):
+            if authenticated:
+                await self.get_auth_token()
+                authorization = self._default_headers['Authorization']
+            request_headers = self._request_headers(headers, authenticated, cached and cached[0])
+
+            async with self._get_session().request(method, url, params=params, headers=request_headers,
+                                                   **self._body_kwargs(request_headers, data)) as r:
+                refresh_token = r.status == 401 and authenticated and not token_refreshed
+                if attempt == self.max_retries or not (refresh_token or r.status in retry_statuses):
+                    if cached and r.status == 304:
+                        if self.debug:
+                            print("Response from Vodafone M2M API not modified, reusing cached response")
+                        return json_loads(cached[1])
+                    body = await r.read()
+                    json_response = json_loads(body)
+                    etag = r.headers.get('ETag')
+                    break
+
+            if refresh_token:
+                # The token was rejected, most likely it expired in flight.
+                self._invalidate_token(authorization)
+                token_refreshed = True
+            else:
+                await asyncio.sleep(self._retry_delay(attempt))
+            if self.debug:
+                print(f"Retrying {method} request to {url} after status {r.status}")
+
+        if self.debug:
+            print(f"Got response from Vodafone M2M API: {json_response}")
+
+        json_response = self._handle_api_response(json_response)
+        if use_etag:
+            self._remember_etag(etag_key, etag, body)
+        return json_response
+
+
+class AsyncM2MDevices(M2MDevices, AsyncVodafoneM2M):
+    """
+    asyncio variant of M2MDevices, every request method returns an awaitable.
+
+    BaseClass : M2MDevices, AsyncVodafoneM2M
+    """
+
+    async def get_devices_bulk(self, device_ids, *, max_concurrency=32):
+        """
+        Retrieves device details for many devices concurrently, with at most
+        `max_concurrency` requests in flight at once.
+
+        :param device_ids: Iterable of device ids.
+        :param max_concurrency: (int) Limit on simultaneous requests, at least 1.
+        :return: list of `get_device_details_v2` responses in the order of
+            `device_ids`, with the exception in place of any request that failed.
+
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1, got {}".format(max_concurrency))
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def get_device(device_id):
+            async with semaphore:
+                return await self.get_device_details_v2(device_id)
+
+        return await asyncio.gather(*(get_device(device_id) for device_id in device_ids),
+                                    return_exceptions=True)
@@ -73,6 +73,39 @@ class M2MDevices(VodafoneM2M):
              {'timestamp': '2014-12-24T12:41:25+00:00', 'operation': 'C'},
              {'timestamp': '2014-12-24T12:41:25+00:00', 'operation': 'C'}]}}}}
 
+        """
+        endpoint, params = self._device_history_request(device_id, start_date, end_date, page_size, page_number)
+        return self._send_message('get', endpoint, params=params)
+
+    def iter_device_history_v2(self, device_id, start_date, end_date, page_size, page_number):
+        """
+        Same as `get_device_history_v2`, but parses the response as it arrives and
+        yields each deviceHistoryItem instead of returning the whole page.
+        A failure return code is raised as ValueError while iterating. Iterate the
+        result fully or use it as a context manager so the connection is released.
+        Requires the 'ijson' package, and is only available on the sync client with
+        the default 'requests' transport, other clients raise ValueError.
+
+        :param device_id:
+        :param start_date:
+        :param end_date:
+        :param page_size:
+        :param page_number:
+        :return: StreamedItems
+
+        {'timestamp': '2014-12-24T13:21:26+00:00', 'operation': 'C'}
+
+        """
+        endpoint, params = self._device_history_request(device_id, start_date, end_date, page_size, page_number)
+        return self._send_message('get', endpoint, params=params,
+                                  stream='getDeviceHistoryResponse.return.deviceHistoryList.deviceHistoryItem.item')
+
+    @staticmethod
+    def _device_history_request(device_id, start_date, end_date, page_size, page_number):
+        """
+        Endpoint and query for a getDeviceHistoryV2 request.
+
+        :return: (str, dict)
         """
         endpoint = "/m2m/v1/devices/{device_id}/history".format(device_id=device_id)
         params = {'startDate': start_date,
@@ -80,7 +113,7 @@ class M2MDevices(VodafoneM2M):
                   'pageSize': page_size,
                   'pageNumber': page_number
                   }
-        return self._send_message('get', endpoint, params=params)
+        return endpoint, params
 
     def get_device_registration_details(self, device_id):
         """
@@ -106,7 +139,7 @@ class M2MDevices(VodafoneM2M):
 
         """
         endpoint = "/m2m/v1/devices/{device_id}/registration".format(device_id=device_id)
-        return self._send_message('get', endpoint)
+        return self._send_message('get', endpoint, use_etag=True)
 
     def set_device_details_v4(self,
                            device_id,
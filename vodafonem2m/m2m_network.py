@@ -1,10 +1,19 @@
+import json
+
 from vodafonem2m.vodafonem2m import VodafoneM2M
 
 
+def _json_string(value):
+    return json.dumps(str(value)).encode('utf-8')
+
+
 class M2MNetwork(VodafoneM2M):
     home = 'network'
     scope = "M2M_NETWORK_ALL"
 
+    # Pre-encoded body for set_sim_state: simId, simIdType and state are filled in as JSON strings.
+    _SIM_STATE_TEMPLATE = b'{"setSimDetails": {"simId": %s, "simIdType": %s, "state": %s}}'
+
     def get_sim_details(self, sim_id, sim_id_type):
         """
         This API is provided to allow Customer Systems to retrieve detailed
@@ -73,6 +82,31 @@ class M2MNetwork(VodafoneM2M):
         data = {"setSimDetails": dict((k, v) for k, v in params_data.items() if v is not None)}
         return self._send_message('put', endpoint, data=data)
 
+    def set_sim_state(self, sim_id, sim_id_type, state):
+        """
+        Change the state of a SIM, the same request as `set_sim_details` with only
+        `state` set. The body is filled into a pre-encoded template rather than
+        built and serialised as a dict, which adds up when changing many SIMs.
+
+        :param sim_id: (str)
+        :param sim_id_type: (str)
+        :param state: (str) See `set_sim_details` for the available states.
+        :return:
+
+        {"setSimDetailsResponse":
+            {"return": {
+                "returnCode": {
+                    "majorReturnCode":000,
+                    "minorReturnCode":0000
+                }
+            }
+        }
+
+        """
+        endpoint = "/m2m/rest/v1/network/sim"
+        data = self._SIM_STATE_TEMPLATE % (_json_string(sim_id), _json_string(sim_id_type), _json_string(state))
+        return self._send_message('put', endpoint, data=data)
+
     def get_sim_details_v2(self, sim_id, sim_id_type):
         """
         This API is provided to allow Customer Systems to retrieve detailed
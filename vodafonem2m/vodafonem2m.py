@@ -4,9 +4,36 @@
 # 30/10/2019
 
 
-from datetime import datetime, timedelta
 import base64
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import JSONDecodeError as RequestsJSONDecodeError
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+_RETURN_CODE_KEYS = ('majorReturnCode', 'minorReturnCode', 'description')
 
 class VodafoneM2M:
     """
@@ -14,15 +41,31 @@ class VodafoneM2M:
     All requests default to the production `api_url`: 'https://api.m2m.vodafone.com'.
     Attributes:
         url (str): The api url for this client instance to use.
-        session (requests.Session): Persistent HTTP connection object.
+        session (requests.Session or httpx.Client): Persistent HTTP connection object.
     """
 
     token = None
     home = None
     scope = None
+    # Refresh the token this many seconds before the API says it expires.
+    token_expiry_margin = 60
+    # Connection pool sizing for the shared session.
+    pool_connections = 32
+    pool_maxsize = 64
+    # Retries for rejected tokens and transient errors, with full jitter backoff.
+    max_retries = 3
+    retry_statuses = (429, 502, 503, 504)
+    # A gateway 502/504 may come after the upstream already acted, so POSTs are
+    # only retried on statuses that guarantee nothing was done.
+    post_retry_statuses = (429, 503)
+    retry_backoff_base = 0.2
+    retry_backoff_cap = 30.0
+    # Upper bound on the number of ETag validated responses remembered per client.
+    etag_cache_size = 1024
 
     def __init__(self, username, password, client_id, client_secret,
-                 api_url="https://api.m2m.vodafone.com", debug=False):
+                 api_url="https://api.m2m.vodafone.com", debug=False, transport='requests',
+                 token_cache_path=None):
         """
         Create an instance of the VodafoneM2M class.
 
@@ -31,52 +74,202 @@ class VodafoneM2M:
         :param client_id: (str): Application Consumer Key obtained from your operator.
         :param client_secret: (str): Application Consumer Secret obtained from your operator.
         :param api_url: (str) url
+        :param transport: (str) 'requests' (default), or 'httpx' to multiplex requests
+            over a single HTTP/2 connection. 'httpx' requires the 'httpx[http2]' package
+            and does not support streamed responses. Applies to the sync client only,
+            AsyncVodafoneM2M always uses aiohttp.
+        :param token_cache_path: (str) Optional JSON file in which auth tokens are shared
+            between processes, so a new client can reuse an unexpired token instead of
+            requesting one. The file holds live tokens and is created readable by its owner only.
 
         """
-        self.__username = username
-        self.__password = password
+        if transport not in ('requests', 'httpx'):
+            raise ValueError("Unknown transport: {}".format(transport))
+        if transport == 'httpx' and httpx is None:
+            raise ImportError("The 'httpx' transport requires the 'httpx[http2]' package")
+        self.transport = transport
         self.debug = debug
-        self.__client_id = client_id
-        self.__client_secret = client_secret
-        self.session = requests.Session()
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._set_credentials(username, password)
         self.url = api_url
-        self.set_auth_token(username, password)
+        self.token_cache_path = token_cache_path
+        self._etag_cache = {}
+        self._home_endpoint = '/m2m/v1/{}'.format(self.home)
+        self._refresh_lock = threading.Lock()
+        self._open_session()
+
+    def _open_session(self):
+        """
+        Create the persistent HTTP session and fetch the first auth token.
+        """
+        if self.transport == 'httpx':
+            self.session = httpx.Client(http2=True, limits=httpx.Limits(
+                max_keepalive_connections=self.pool_connections, max_connections=self.pool_maxsize))
+        else:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                  pool_maxsize=self.pool_maxsize, pool_block=False)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+        if not self._load_cached_token():
+            self.set_auth_token()
 
-    def set_auth_token(self, username, password):
+    def set_auth_token(self, username=None, password=None):
         """
         Set the auth token.
 
+        :param username: Replaces the stored username when given.
+        :param password: Replaces the stored password when given.
+        :return:
+        """
+        if username is not None or password is not None:
+            self._set_credentials(username, password)
+        token = self._send_message('post', '/m2m/v1/oauth2/access-token',
+                                   data=self._token_body, headers=self._token_headers)
+        self._store_token(token)
+        self._save_cached_token()
+
+    def _set_credentials(self, username=None, password=None):
+        """
+        Store the credentials and build the access token request from them.
+        Credentials rarely change, so the headers and form body are built
+        once here rather than on every token refresh.
+
         :param username:
         :param password:
-        :return:
         """
-        str_usernamepassword = f"{username}:{password}"
-        b64_usernamepassword = base64.standard_b64encode(str_usernamepassword.encode('utf-8'))
-        str_b64_usernamepassword = b64_usernamepassword.decode('utf-8')
-        headers = {
+        if username is not None:
+            self._username = username
+        if password is not None:
+            self._password = password
+        str_usernamepassword = f"{self._username}:{self._password}"
+        str_b64_usernamepassword = base64.standard_b64encode(str_usernamepassword.encode('utf-8')).decode('utf-8')
+        self._token_headers = {
             'Authorization': "Basic " + str_b64_usernamepassword,
             'Content-Type': "application/x-www-form-urlencoded",
             'Accept': "*/*",
             'Cache-Control': "no-cache",
-            'Host': "api.m2m.vodafone.com",
             'Accept-Encoding': "gzip, deflate",
-            'Content-Length': "125",
-            'Connection': "keep-alive",
-            'cache-control': "no-cache"
+            'Connection': "keep-alive"
         }
-        string = "grant_type=client_credentials&client_id={client_id}&client_secret={client_secret}&scope={scope}"
-        data = string.format(client_id=self.__client_id, client_secret=self.__client_secret, scope=f"{self.scope}")
-        self.token = self._send_message('post', '/m2m/v1/oauth2/access-token', data=data, headers=headers)
-        self.token['utc_timestamp'] = datetime.utcnow()
+        self._token_body = urlencode({
+            'grant_type': 'client_credentials',
+            'client_id': self._client_id,
+            'client_secret': self._client_secret,
+            'scope': self.scope or ''
+        })
+
+    def _store_token(self, token, expires_in=None):
+        """
+        Keep a freshly issued token and work out when it must be refreshed.
+
+        :param token: (dict) The access token response.
+        :param expires_in: (float) Seconds the token remains valid, defaults to the
+            token's own 'expires_in'.
+        """
+        if expires_in is None:
+            expires_in = int(token['expires_in'])
+        # Built once per token and swapped in whole, requests only read it.
+        default_headers = CaseInsensitiveDict({
+            'Authorization': "Bearer " + token['access_token'],
+            'Content-Type': 'application/json',
+            'accept': 'application/json'
+        })
+        # Monotonic, so wall clock adjustments can't make a stale token look valid.
+        self._token_expires_at = time.monotonic() + expires_in - self.token_expiry_margin
+        self._default_headers = default_headers
+        # Assigned last, a token is only in use once everything derived from it is in place.
+        self.token = token
+
+    def _token_cache_key(self):
+        """
+        Key for this client's token in the token cache file, hashed so that
+        usernames and client ids aren't written out in plain text.
+
+        :return: (str)
+        """
+        key = '\n'.join((self._url_base, self._username, self._client_id, self.scope or ''))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _read_token_cache(self):
+        """
+        Read the token cache file.
+
+        :return: (dict) Cache entries by key, empty if the file is missing or unreadable.
+        """
+        try:
+            with open(self.token_cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def _load_cached_token(self):
+        """
+        Reuse an unexpired token from the token cache file, if there is one.
+
+        :return: True if a cached token was loaded, False otherwise.
+        """
+        if not self.token_cache_path:
+            return False
+        entry = self._read_token_cache().get(self._token_cache_key())
+        if not isinstance(entry, dict):
+            return False
+        token = entry.get('token')
+        expires_at = entry.get('expires_at')
+        if (not isinstance(token, dict) or not isinstance(token.get('access_token'), str)
+                or not isinstance(expires_at, (int, float))):
+            return False
+        expires_in = expires_at - time.time()
+        if expires_in <= self.token_expiry_margin:
+            return False
+        self._store_token(token, expires_in)
+        if self.debug:
+            print("Reusing auth token from the token cache")
+        return True
+
+    def _save_cached_token(self):
+        """
+        Write the current token to the token cache file, dropping expired entries.
+        The file is replaced atomically so other processes never read a partial write.
+        """
+        if not self.token_cache_path:
+            return
+        now = time.time()
+        cache = {k: v for k, v in self._read_token_cache().items()
+                 if isinstance(v, dict) and isinstance(v.get('expires_at'), (int, float)) and v['expires_at'] > now}
+        cache[self._token_cache_key()] = {
+            'token': self.token,
+            'expires_at': now + self._token_expires_at - time.monotonic() + self.token_expiry_margin
+        }
+        directory = os.path.dirname(os.path.abspath(self.token_cache_path))
+        try:
+            # mkstemp creates the file readable by its owner only.
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.vodafonem2m-token-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(cache, f)
+                os.replace(tmp_path, self.token_cache_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            # The cache is an optimisation, a failed write must not fail the request.
+            if self.debug:
+                print(f"Could not write the token cache: {e}")
 
     def get_auth_token(self):
         """
         Gets the auth token, refreshing it if necessary.
+        Only one thread refreshes an expired token, the others wait and reuse it.
 
         :return: The auth token.
         """
         if self.token is None or self._is_token_expired():
-            self.set_auth_token(self.__username, self.__password)  # Refresh the token
+            with self._refresh_lock:
+                if self.token is None or self._is_token_expired():
+                    self.set_auth_token()  # Refresh the token
         return self.token['access_token']
 
     def _is_token_expired(self):
@@ -85,9 +278,82 @@ class VodafoneM2M:
 
         :return: True if the token is expired, False otherwise.
         """
-        # Adjust to dynamically check based on the stored expiration
-        token_expiry = self.token['utc_timestamp'] + timedelta(seconds=int(self.token['expires_in']))
-        return datetime.utcnow() > token_expiry
+        return time.monotonic() >= self._token_expires_at
+
+    def _invalidate_token(self, authorization):
+        """
+        Mark the current auth token as expired so the next request refreshes it,
+        unless another thread already replaced the token that was rejected.
+
+        :param authorization: (str) The Authorization header the rejected request was sent with.
+        """
+        with self._refresh_lock:
+            self._expire_token(authorization)
+
+    def _expire_token(self, authorization):
+        if self._default_headers.get('Authorization') == authorization:
+            self._token_expires_at = float('-inf')
+
+    def _retry_statuses(self, method):
+        """
+        The response statuses on which a request with this method is retried.
+
+        :param method: (str) HTTP method.
+        :return: tuple
+        """
+        return self.post_retry_statuses if method.lower() == 'post' else self.retry_statuses
+
+    @property
+    def url(self):
+        return self._url
+
+    @url.setter
+    def url(self, value):
+        self._url = value
+        # Kept without a trailing slash so endpoint paths join cleanly.
+        self._url_base = value.rstrip('/')
+
+    def _endpoint_url(self, endpoint):
+        """
+        Resolve an endpoint path against the api url.
+
+        :param endpoint: (str) Path starting with '/'.
+        :return: (str) The full url.
+        """
+        return self._url_base + endpoint
+
+    @staticmethod
+    def _etag_key(endpoint, params):
+        """
+        Key for the ETag cache, a response depends on both the endpoint and its query.
+
+        :param endpoint:
+        :param params:
+        :return: tuple
+        """
+        return endpoint, tuple(sorted(params.items())) if params else None
+
+    def _remember_etag(self, key, etag, body):
+        """
+        Keep a validated response so it can be reused after a 304 Not Modified.
+        The raw body is kept and parsed again on reuse, so each caller gets its
+        own dict and changes made by one caller never leak into the next.
+
+        :param key: From `_etag_key`.
+        :param etag: (str) The ETag response header, if any.
+        :param body: (bytes) The raw response body.
+        """
+        if etag and (key in self._etag_cache or len(self._etag_cache) < self.etag_cache_size):
+            self._etag_cache[key] = (etag, body)
+
+    def _retry_delay(self, attempt):
+        """
+        Full jitter backoff, a random delay up to an exponentially growing cap.
+
+        :param attempt: (int) Zero based number of the attempt that failed.
+        :return: (float) Seconds to wait before the next attempt.
+        """
+        return random.uniform(0, min(self.retry_backoff_cap, self.retry_backoff_base * 2 ** attempt))
 
     def get_home_document(self):
         """
@@ -109,7 +375,7 @@ class VodafoneM2M:
            'type': 'application/vnd.vodafone.a42.m2m.devices+json'}}}
 
         """
-        return self._send_message('get', '/m2m/v1/{}'.format(self.home))
+        return self._send_message('get', self._home_endpoint, use_etag=True)
 
     @staticmethod
     def _handle_api_response(json_response):
@@ -131,17 +397,16 @@ class VodafoneM2M:
                 raise ValueError("Service Error:: {} : {}".format(
                     json_response["id"], json_response["description"]))
         else:
-            try:
-                codes = json_response[list(json_response.keys())[0]]['return']['returnCode']
-                if codes['majorReturnCode'] != '000' or codes['minorReturnCode'] != '0000':
-                    raise ValueError(
-                            "Return Code Description:: {} Error:: Major: {}, Minor: {}".format(
-                            codes['description'], codes['majorReturnCode'], codes['minorReturnCode'])
-                    )
-            except KeyError:
-                pass
-            except TypeError:
-                pass
+            response = json_response[next(iter(json_response))]
+            result = response.get('return') if isinstance(response, dict) else None
+            codes = result.get('returnCode') if isinstance(result, dict) else None
+            # Only a complete return code is checked, partial ones pass through.
+            if (isinstance(codes, dict) and all(k in codes for k in _RETURN_CODE_KEYS)
+                    and (codes['majorReturnCode'] != '000' or codes['minorReturnCode'] != '0000')):
+                raise ValueError(
+                        "Return Code Description:: {} Error:: Major: {}, Minor: {}".format(
+                        codes['description'], codes['majorReturnCode'], codes['minorReturnCode'])
+                )
         return json_response
 
     def testing(self):
@@ -149,35 +414,240 @@ class VodafoneM2M:
         params = {"echo": "testing"}
         return self._send_message('get', endpoint, params=params)
 
-    def _send_message(self, method, endpoint, params=None, headers=None, data=None):
+    def _send_message(self, method, endpoint, params=None, headers=None, data=None, stream=None,
+                      use_etag=False):
         """
         Send API request.
 
         :param method:
         :param endpoint:
         :param params:
-        :param headers:
-        :param data:
-        :return: dict
+        :param headers: Extra headers, merged over the Bearer auth headers. Requests
+            that carry their own 'Authorization' header are sent without the Bearer token.
+        :param data: Request body, encoded as JSON for 'application/json' requests
+            unless it is already `bytes`.
+        :param stream: (str) Optional ijson prefix, e.g. 'someResponse.return.list.item'.
+            When given the body is not buffered, a `StreamedItems` iterator of the
+            matching items is returned instead. Errors in the body are raised while
+            iterating, once the parser reaches them. Requires the 'ijson' package.
+        :param use_etag: (bool) For idempotent GETs, revalidate the last response with
+            If-None-Match and return it again, without a body download, on 304 Not Modified.
+        :return: dict, or `StreamedItems` when `stream` is given
 
         """
-        
-        url = self.url + endpoint
+        if stream and ijson is None:
+            raise ImportError("Streaming responses requires the 'ijson' package")
+        if stream and self.transport == 'httpx':
+            raise ValueError("stream is only supported by the 'requests' transport")
+
+        url = self._endpoint_url(endpoint)
         if self.debug:
             print(f"Sending {method} request to {url}: data: {data}, params: {params}, headers: {headers}")
         
-        if not headers:
-            headers = {
-                'Authorization': "Bearer {}".format(self.get_auth_token()),
-                'Content-Type': 'application/json',
-                'accept': 'application/json'
-            }
-            r = self.session.request(method, url, json=data, params=params, headers=headers)
+        if use_etag:
+            etag_key = self._etag_key(endpoint, params)
+            cached = self._etag_cache.get(etag_key)
         else:
-            r = self.session.request(method, url, data=data, params=params, headers=headers)
+            cached = None
+        headers, authenticated = self._caller_headers(headers)
+        retry_statuses = self._retry_statuses(method)
+        request = self._request
+
+        token_refreshed = False
+        for attempt in range(self.max_retries + 1):
+            if authenticated:
+                self.get_auth_token()
+                authorization = self._default_headers['Authorization']
+            request_headers = self._request_headers(headers, authenticated, cached and cached[0])
+            r = request(method, url, params=params, headers=request_headers, stream=bool(stream),
+                        **self._body_kwargs(request_headers, data))
+
+            if attempt == self.max_retries:
+                break
+            if r.status_code == 401 and authenticated and not token_refreshed:
+                # The token was rejected, most likely it expired in flight.
+                self._invalidate_token(authorization)
+                token_refreshed = True
+            elif r.status_code in retry_statuses:
+                time.sleep(self._retry_delay(attempt))
+            else:
+                break
+            r.close()
+            if self.debug:
+                print(f"Retrying {method} request to {url} after status {r.status_code}")
+
+        if stream and r.status_code < 400:
+            return self._iter_items(r, stream)
 
-        json_response = r.json()
+        if cached and r.status_code == 304:
+            if self.debug:
+                print("Response from Vodafone M2M API not modified, reusing cached response")
+            return json_loads(cached[1])
+
+        json_response = self._decode_response(r)
         if self.debug:
             print(f"Got response from Vodafone M2M API: {json_response}")
 
-        return self._handle_api_response(json_response)
+        json_response = self._handle_api_response(json_response)
+        if stream:
+            # An error status whose body didn't raise above, the caller expects items, not this body.
+            raise ValueError("Streamed request failed with status {}: {}".format(r.status_code, json_response))
+        if use_etag:
+            self._remember_etag(etag_key, r.headers.get('ETag'), r.content)
+        return json_response
+
+    @staticmethod
+    def _decode_response(r):
+        """
+        Parse a response body, raising the same error as `requests.Response.json`
+        for a body that isn't JSON, so `except requests.RequestException` still catches it.
+
+        :param r: The response.
+        :return: The parsed body.
+        """
+        try:
+            return json_loads(r.content)
+        except ValueError as e:
+            raise RequestsJSONDecodeError(getattr(e, 'msg', str(e)), getattr(e, 'doc', ''),
+                                          getattr(e, 'pos', 0)) from e
+
+    @staticmethod
+    def _caller_headers(headers):
+        """
+        Caller supplied headers as a case-insensitive dict, so they override the
+        defaults whatever their spelling, and whether the request should carry the
+        Bearer token, which it does unless it brings its own Authorization header.
+
+        :param headers: (dict) Caller supplied headers, or None.
+        :return: (CaseInsensitiveDict or None, bool)
+        """
+        if not headers:
+            return None, True
+        headers = CaseInsensitiveDict(headers)
+        return headers, 'Authorization' not in headers
+
+    def _request_headers(self, headers, authenticated, etag=None):
+        """
+        Headers for one request: the cached Bearer auth headers overridden by any
+        caller supplied headers, plus If-None-Match when revalidating a response.
+
+        :param headers: (CaseInsensitiveDict) Caller supplied headers, or None.
+        :param authenticated: (bool) Whether to send the Bearer auth headers.
+        :param etag: (str) ETag of a cached response, if any.
+        :return: CaseInsensitiveDict
+        """
+        if not authenticated:
+            request_headers = headers
+        elif headers:
+            request_headers = self._default_headers.copy()
+            request_headers.update(headers)
+        else:
+            request_headers = self._default_headers
+        if etag:
+            request_headers = request_headers.copy()
+            request_headers['If-None-Match'] = etag
+        return request_headers
+
+    @staticmethod
+    def _body_kwargs(headers, data):
+        """
+        Encode the body as JSON for JSON requests, otherwise send it as is.
+
+        :param headers: (CaseInsensitiveDict) The request headers.
+        :param data: The request body.
+        :return: dict of keyword arguments for the request.
+        """
+        if isinstance(data, bytes) or not headers.get('Content-Type', '').startswith('application/json'):
+            return {'data': data}
+        return {'json': data}
+
+    def _request(self, method, url, params=None, headers=None, json=None, data=None, stream=False):
+        """
+        Send a single HTTP request with the configured transport.
+
+        :return: requests.Response or httpx.Response
+        """
+        if self.transport == 'httpx':
+            # httpx takes a pre-encoded body as `content`.
+            return self.session.request(method, url, params=params, headers=headers, json=json, content=data)
+        return self.session.request(method, url, params=params, headers=headers, json=json, data=data,
+                                    stream=stream)
+
+    @classmethod
+    def _checked_events(cls, events, prefix):
+        """
+        Pass ijson parse events through, checking the response for errors on the way.
+        The returnCode under '<response>.return' is checked as soon as it is complete,
+        and any top level error fields once the body ends.
+
+        :param events: ijson parse events.
+        :param prefix: (str) ijson prefix of the streamed items.
+        :return: generator
+        """
+        root = prefix.split('.', 1)[0]
+        return_code_prefix = root + '.return.returnCode'
+        codes = {}
+        top_level = {}
+        for event_prefix, event, value in events:
+            if event not in ('start_map', 'end_map', 'start_array', 'end_array', 'map_key'):
+                if '.' not in event_prefix:
+                    top_level[event_prefix] = value
+                elif event_prefix.rsplit('.', 1)[0] == return_code_prefix:
+                    codes[event_prefix.rsplit('.', 1)[1]] = value
+            elif event == 'end_map' and event_prefix == return_code_prefix:
+                cls._handle_api_response({root: {'return': {'returnCode': codes}}})
+            yield event_prefix, event, value
+        if top_level:
+            cls._handle_api_response(top_level)
+
+    @classmethod
+    def _iter_items(cls, r, prefix):
+        """
+        Incrementally parse a streamed response, yielding the items under `prefix`.
+
+        :param r: (requests.Response) A response opened with stream=True.
+        :param prefix: (str) ijson prefix of the items to yield.
+        :return: StreamedItems
+        """
+        r.raw.decode_content = True
+        events = cls._checked_events(ijson.parse(r.raw, use_float=True), prefix)
+        return StreamedItems(r, ijson.items(events, prefix))
+
+
+class StreamedItems:
+    """
+    Iterator over the items of a streamed response. The response, and with it
+    the pooled connection, is released once the items are exhausted, on an error,
+    on `close()` or when leaving a `with` block, so iterate it fully or use:
+
+        with m2m.iter_device_history_v2(...) as items:
+            for item in items:
+                ...
+    """
+
+    def __init__(self, response, items):
+        self._response = response
+        self._items = items
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._items)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Stop parsing and release the response.
+        """
+        self._items.close()
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()